@@ -39,10 +39,15 @@ class Discriminator(nn.Module):
         self.fc2 = nn.Linear(64, 32)
         self.fc3 = nn.Linear(32, 1)
 
+        # Kept between calls to fit(), so that fine-tuning resumes its state
+        self.optimizer = torch.optim.Adam(self.parameters())
+
     # x represents our data
     def forward(self, x):
         """Mark the flow of data throughout the network"""
 
+        # Genotype matrices are stored as uint8, cast them here
+        x = x.float()
         x = self.batch1(x)
         x = self.conv1(x)
         x = F.relu(x)
@@ -88,20 +93,54 @@ class Discriminator(nn.Module):
         y_prob = y_prob > 0.5
         return (y_true == y_prob).sum().item() / y_true.size(0)
 
-    def fit(self, trainflow, valflow, epochs, lr):
+    def fit(
+        self,
+        trainflow,
+        valflow,
+        epochs,
+        lr,
+        mixed_precision=True,
+        fine_tune_steps=None,
+    ):
         """Train the discriminator model with the Binary Cross-Entropy loss.
         trainflow: PyTorch data loader for the training dataset
         valflow: PyTorch data loader for the validation dataset
         epochs: Number of iterations through the training dataset
         lr: Learning rate for gradient descent with Adam
+        mixed_precision: Use bfloat16/float16 autocasting when training on GPU
+        fine_tune_steps: If given, keep the current weights and optimizer state
+            and train for only this number of mini-batches in a single epoch
         """
 
-        optimizer = torch.optim.Adam(self.parameters(), lr)
+        optimizer = self.optimizer
+        for group in optimizer.param_groups:
+            group["lr"] = lr
         lossf = nn.BCELoss()
-        best_val_loss = 1.0
-
-        print("Initializing weights of the model, deleting previous ones")
-        self.apply(self.weights_init)
+        device = next(self.parameters()).device
+
+        # Mixed precision on GPU, with bfloat16 if supported. Otherwise use
+        # float16 with loss scaling to avoid underflowing gradients
+        amp = mixed_precision and device.type == "cuda"
+        amp_dtype = torch.float16
+        if amp and torch.cuda.is_bf16_supported():
+            amp_dtype = torch.bfloat16
+        scaler = torch.amp.GradScaler(
+            "cuda", enabled=amp and amp_dtype == torch.float16
+        )
+        best_val_loss = float("inf")
+
+        if fine_tune_steps is not None and fine_tune_steps < 1:
+            raise ValueError(
+                f"fine_tune_steps must be at least 1, not {fine_tune_steps}"
+            )
+
+        if fine_tune_steps is None:
+            print("Initializing weights of the model, deleting previous ones")
+            self.apply(self.weights_init)
+            optimizer.state.clear()
+        else:
+            print(f"Fine-tuning the model for {fine_tune_steps} mini-batches")
+            epochs = 1
         self.train()
 
         # Loop over the dataset multiple times
@@ -110,16 +149,22 @@ class Discriminator(nn.Module):
             train_loss, val_loss, acc_train, acc_val = 0.0, 0.0, 0.0, 0.0
 
             # For each batch of training data
-            for i, (inputs, labels) in enumerate(trainflow, 1):
+            for i, (inputs, labels) in enumerate(
+                prefetch_to_device(trainflow, device), 1
+            ):
 
                 # Zero the parameter gradients
                 optimizer.zero_grad()
 
-                # Compute model predictions, compute loss and perform back-prop
-                out = self(inputs)
+                # Compute model predictions, compute loss and perform back-prop.
+                # BCELoss is not autocast-safe, so it is computed in float32
+                with torch.autocast("cuda", dtype=amp_dtype, enabled=amp):
+                    out = self(inputs)
+                out = out.float()
                 loss = lossf(out, labels)
-                loss.mean().backward()
-                optimizer.step()
+                scaler.scale(loss.mean()).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 # Print statistics
                 train_loss += loss.item()
@@ -136,13 +181,20 @@ class Discriminator(nn.Module):
                         end="\r",
                     )
 
+                if fine_tune_steps is not None and i >= fine_tune_steps:
+                    break
+
             print("")
             # Calculate stats on validation data with no gradient descent
             with torch.no_grad():
                 # For each batch of validation data
-                for j, (genmats, labels) in enumerate(valflow, 1):
+                for j, (genmats, labels) in enumerate(
+                    prefetch_to_device(valflow, device), 1
+                ):
                     # Compute model predictions, compute loss and stats
-                    preds = self(genmats)
+                    with torch.autocast("cuda", dtype=amp_dtype, enabled=amp):
+                        preds = self(genmats)
+                    preds = preds.float()
                     val_loss += lossf(preds, labels).item()
                     acc_val += self.get_accuracy(labels, preds)
                     print(
@@ -156,7 +208,7 @@ class Discriminator(nn.Module):
                 # Save the model weights with the lowest validation error
                 if (val_loss / j) < best_val_loss:
                     best_val_loss = val_loss / j
-                    best_train_acc = acc_train / len(trainflow)
+                    best_train_acc = acc_train / i
                     best_epoch = epoch + 1
                     best_model = copy.deepcopy(self.state_dict())
 
@@ -173,3 +225,36 @@ class Discriminator(nn.Module):
         with torch.no_grad():
             preds = self(inputs)
         return preds
+
+
+def prefetch_to_device(loader, device):
+    """Iterate over the batches of a data loader, copying the next batch to
+    the device in a side CUDA stream while the current one is being used"""
+
+    if device.type != "cuda":
+        yield from loader
+        return
+
+    stream = torch.cuda.Stream(device)
+    current = torch.cuda.current_stream(device)
+    pending = None
+    for batch in loader:
+        # Copy from pinned host memory without blocking the compute stream
+        # Genotype matrices are laid out as channels_last, like the model
+        with torch.cuda.stream(stream):
+            batch = [t.to(device, non_blocking=True) for t in batch]
+            batch = [
+                t.contiguous(memory_format=torch.channels_last) if t.dim() == 4 else t
+                for t in batch
+            ]
+        if pending is not None:
+            yield pending
+
+        # Kernels using the batch must wait for its copy to finish
+        current.wait_stream(stream)
+        for t in batch:
+            t.record_stream(current)
+        pending = batch
+
+    if pending is not None:
+        yield pending
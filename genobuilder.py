@@ -2,6 +2,7 @@ import os
 from collections import OrderedDict
 import concurrent.futures
 import pickle
+import tempfile
 import argparse
 import stdpopsim
 import zarr
@@ -18,12 +19,20 @@ _ex = None
 
 
 def executor(p):
+    """Return the process pool shared by all the simulations. It is created
+    only once, so worker processes are reused between calls"""
     global _ex
     if _ex is None:
-        _ex = concurrent.futures.ProcessPoolExecutor(max_workers=p)
+        _ex = concurrent.futures.ProcessPoolExecutor(max_workers=p or os.cpu_count())
     return _ex
 
 
+def chunksize(num_tasks, p):
+    """Number of tasks sent to each worker at once, so that every worker
+    receives a few chunks and the IPC overhead per replicate is amortized"""
+    return max(1, num_tasks // (4 * (p or os.cpu_count())))
+
+
 def do_sim(args):
     """Perform msprime simulations with multiprocessing"""
 
@@ -103,8 +112,7 @@ class Genobuilder:
     def set_parameters(self, sim_source, params):
 
         self._sim_source = sim_source
-        self._params = params
-        self.inferable_params = [p for p in self.params.values() if p.inferable]
+        self.params = params
 
     @property
     def num_samples(self):
@@ -142,6 +150,18 @@ class Genobuilder:
     def params(self):
         return self._params
 
+    @property
+    def inferable_params(self):
+        # Built lazily, and cached until the parameters are set again
+        if getattr(self, "_inferable_params", None) is None:
+            self._inferable_params = [p for p in self.params.values() if p.inferable]
+        return self._inferable_params
+
+    @property
+    def inferable_inits(self):
+        params = self.inferable_params
+        return np.fromiter((p.init for p in params), np.float32, len(params))
+
     @property
     def sim_source(self):
         return self._sim_source
@@ -212,6 +232,7 @@ class Genobuilder:
     @params.setter
     def params(self, p):
         self._params = p
+        self._inferable_params = None
 
     @sim_source.setter
     def sim_source(self, s):
@@ -260,7 +281,9 @@ class Genobuilder:
                 )
             )
 
-        mat = np.zeros((self.num_reps, self.num_samples, self.fixed_dim))
+        mat = np.zeros(
+            (self.num_reps, self.num_samples, self.fixed_dim), dtype=np.uint8
+        )
 
         # For each tree sequence output from the simulation
         for i, ts in enumerate(sims):
@@ -277,17 +300,23 @@ class Genobuilder:
         proposals: True for proposal parameter values (calculating D(x) scores)
         """
 
-        # Prepare arguments and empty matrix
+        # Prepare arguments and empty matrix. Allele counts in each window are
+        # small integers, so the matrices are stored as uint8 to save memory
         args = [(self, params, randomize, i, proposals) for i in range(self.num_reps)]
-        mat = np.zeros((self.num_reps, self.num_samples, self.fixed_dim))
+        mat = np.zeros(
+            (self.num_reps, self.num_samples, self.fixed_dim), dtype=np.uint8
+        )
 
         # Executor for multiprocessing
         ex = executor(self.parallelism)
 
         # Do simulations with multiprocessing except if it takes too long
         timeout = 0.5 * self.num_reps
+        chunks = chunksize(self.num_reps, self.parallelism)
         try:
-            for i, m in enumerate(ex.map(do_sim, args, timeout=timeout)):
+            for i, m in enumerate(
+                ex.map(do_sim, args, timeout=timeout, chunksize=chunks)
+            ):
                 mat[i] = m
         except concurrent.futures.TimeoutError:
             print("time out!")
@@ -308,7 +337,9 @@ class Genobuilder:
         # Locate the data contained in the zarr files
         callset = zarr.open_group(self.zarr_path, mode="r")
         num_samples = len(callset["1/samples"])
-        mat = np.zeros((self.num_reps, self.num_samples, self.fixed_dim))
+        mat = np.zeros(
+            (self.num_reps, self.num_samples, self.fixed_dim), dtype=np.uint8
+        )
 
         # Get lists of randomly selected chromosomes and genomic locations
         chrom, pos, loc_region = self.random_sampling_geno(callset)
@@ -327,9 +358,12 @@ class Genobuilder:
 
         # Do simulations with multiprocessing except if it takes too long
         timeout = 0.5 * self.num_reps
+        chunks = chunksize(self.num_reps, self.parallelism)
         try:
             # For each randomly sampled genomic location
-            for i, m in enumerate(ex.map(do_parsing, zip(*args), timeout=timeout)):
+            for i, m in enumerate(
+                ex.map(do_parsing, zip(*args), timeout=timeout, chunksize=chunks)
+            ):
                 mat[i] = m
         except concurrent.futures.TimeoutError:
             print("time out!")
@@ -370,7 +404,9 @@ class Genobuilder:
             )
             sims.append(stdengine.simulate(stdmodel, stdcontig, stdsamples))
 
-        mat = np.zeros((self.num_reps, self.num_samples, self.fixed_dim))
+        mat = np.zeros(
+            (self.num_reps, self.num_samples, self.fixed_dim), dtype=np.uint8
+        )
 
         # Resize from ts, and add sequencing errors if error_prob is given
         for i, ts in enumerate(sims):
@@ -508,7 +544,7 @@ class Genobuilder:
             j = int(variant.site.position * self.fixed_dim / ts.sequence_length)
             m[:, j] += genotypes
 
-        return m.astype(float)
+        return to_genmat(m)
 
     def resize_from_zarr(self, mat, pos, alts):
         """Resizes a matrix using a sum window, given a genotype matrix,
@@ -530,13 +566,15 @@ class Genobuilder:
 
             # Polarise 0 and 1 in genotype matrix by major allele frequency.
             # If allele counts are the same, randomly choose a major allele.
+            # Missing genotypes (-1) are left out, so they are not flipped
+            called = _gt != -1
             if ac1 > ac0 or (ac1 == ac0 and self.rng.random() > 0.5):
-                _gt ^= 1
+                _gt[called] ^= 1
 
             j = int(_pos * self.fixed_dim / self.seq_len) - 1
-            np.add(m[:, j], _gt, out=m[:, j], where=_gt != -1)
+            np.add(m[:, j], _gt, out=m[:, j], where=called)
 
-        return m.astype(float)
+        return to_genmat(m)
 
     def resize_and_mutate(self, ts, p_error):
         """Mutate a tree sequence simulation introducing sequencing errors
@@ -567,7 +605,26 @@ class Genobuilder:
             j = int(variant.site.position * self.fixed_dim / ts.sequence_length)
             m[:, j] += genotypes
 
-        return m.astype(float)
+        return to_genmat(m)
+
+
+def to_genmat(m):
+    """Cast a resized genotype matrix of per-window allele counts to uint8,
+    the storage type of the genotype matrices. Counts grow with the window
+    size (seq_len / fixed_dim), so raise instead of silently wrapping around
+    if any of them is negative or too large. This also runs for the
+    simulations of the MCMC chain, where the error ends the whole run"""
+
+    max_count = np.iinfo(np.uint8).max
+    if m.size and m.min() < 0:
+        raise ValueError(f"A genotype matrix window has {m.min()} alleles")
+    if m.size and m.max() > max_count:
+        raise ValueError(
+            f"A genotype matrix window has {m.max()} alleles, but at most "
+            f"{max_count} fit in uint8. Increase the fixed dimension or reduce "
+            "the sequence length"
+        )
+    return m.astype(np.uint8)
 
 
 def haploidify(genmat, h):
@@ -674,6 +731,62 @@ def draw_genmat(img, name):
     plt.show()
 
 
+def dump_genmats(pack, path, align=64):
+    """Save a list of genotype matrices and labels with pickle protocol 5.
+    The numpy buffers are written out-of-band after the pickle stream, each
+    aligned to `align` bytes, so that load_genmats can memory-map them.
+    The file is written next to `path` and then moved into place, so that
+    an interrupted write never leaves a truncated file behind"""
+
+    buffers = []
+    data = pickle.dumps(pack, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+    header = {"data": data, "sizes": [r.nbytes for r in raws], "align": align}
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as obj:
+            pickle.dump(header, obj, protocol=5)
+            for r in raws:
+                obj.write(b"\0" * (-obj.tell() % align))
+                obj.write(r)
+            obj.flush()
+            os.fsync(obj.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_genmats(path):
+    """Load genotype matrices saved with dump_genmats, mapping the numpy
+    buffers from disk instead of copying them into memory. Files saved as
+    a plain pickle object are also supported"""
+
+    with open(path, "rb") as obj:
+        header = pickle.load(obj)
+        offset = obj.tell()
+
+    if not isinstance(header, dict) or "sizes" not in header:
+        return header
+
+    # Copy-on-write mapping, so the loaded arrays are writable views
+    buffers = []
+    if header["sizes"]:
+        mm = np.memmap(path, dtype=np.uint8, mode="c")
+        for size in header["sizes"]:
+            offset += -offset % header["align"]
+            if offset + size > mm.size:
+                raise ValueError(
+                    f"{path} is truncated, {mm.size} bytes instead of at least "
+                    f"{offset + size}. Delete it to simulate the data again"
+                )
+            buffers.append(mm[offset : offset + size])
+            offset += size
+
+    return pickle.loads(header["data"], buffers=buffers)
+
+
 def locate(sorted_idx, start=None, stop=None):
     """This implementation comes from scikit-allel library.
     Change it a little for copyright lol"""
@@ -875,8 +988,7 @@ if __name__ == "__main__":
             pickle.dump(genob, obj, protocol=pickle.HIGHEST_PROTOCOL)
 
         data_out = str(args.output) + "_data.pkl"
-        with open(data_out, "wb") as obj:
-            pickle.dump(pack, obj, protocol=pickle.HIGHEST_PROTOCOL)
+        dump_genmats(pack, data_out)
 
         print("Data simulation finished")
 
@@ -5,12 +5,54 @@ import argparse
 import torch
 import torch.nn as nn
 import numpy as np
-from mcmcgan import MCMCGAN
+from mcmcgan import MCMCGAN, limit_tf_gpu_memory
 from discriminator import Discriminator
-from genobuilder import Genobuilder
+from genobuilder import Genobuilder, dump_genmats, load_genmats
 from training_utils import mcmc_diagnostic_plots
 
 
+def positive_int(value):
+    """Argument type for integer options that must be at least 1"""
+
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return n
+
+
+def update_dataloader(loader, x, y, device, batch_size=32, shuffle=True):
+    """Copy the data and labels into the host buffers of a data loader. The
+    buffers live in shared memory, so the persistent workers see the new data
+    without rebuilding the loader. A new data loader is only built if there
+    is none yet, or if the shape of the data has changed"""
+
+    x = torch.from_numpy(x)
+    y = torch.from_numpy(y).float().unsqueeze(-1)
+
+    if loader is None or any(
+        buf.shape != t.shape or buf.dtype != t.dtype
+        for buf, t in zip(loader.dataset.tensors, (x, y))
+    ):
+        dataset = torch.utils.data.TensorDataset(
+            torch.empty_like(x).share_memory_(), torch.empty_like(y).share_memory_()
+        )
+        # Batches are pinned for asynchronous copies when the device is a GPU
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            pin_memory=device.type == "cuda",
+            num_workers=2,
+            persistent_workers=True,
+            prefetch_factor=4,
+        )
+
+    for buf, t in zip(loader.dataset.tensors, (x, y)):
+        buf.copy_(t)
+
+    return loader
+
+
 def run_genomcmcgan(
     genobuilder,
     kernel_name,
@@ -21,10 +63,16 @@ def run_genomcmcgan(
     num_mcmc_burnin,
     seed,
     parallelism,
+    fine_tune_steps,
+    fine_tune_lr,
+    tf_gpu_memory,
 ):
 
     np.random.seed(seed)
 
+    # Limit the GPU memory for the MCMC kernels before any TensorFlow op runs
+    limit_tf_gpu_memory(tf_gpu_memory)
+
     # Check if folder with results exists, and create it otherwise
     if not os.path.exists("./results"):
         os.makedirs("./results")
@@ -33,12 +81,14 @@ def run_genomcmcgan(
         genob = pickle.load(obj)
     genob.parallelism = parallelism
 
-    # Generate the training and validation datasets
-    if data_path:
-        with open(data_path, "rb") as obj:
-            xtrain, ytrain, xval, yval = pickle.load(obj)
+    # Generate the training and validation datasets, using data_path as a
+    # disk cache so that the initial simulations are only run once
+    if data_path and os.path.isfile(data_path):
+        xtrain, ytrain, xval, yval = load_genmats(data_path)
     else:
         xtrain, xval, ytrain, yval = genob.generate_data(num_reps=1000)
+        if data_path:
+            dump_genmats([xtrain, ytrain, xval, yval], data_path)
 
     # Initialize the MCMCGAN object and the Discriminator
     mcmcgan = MCMCGAN(genob, kernel_name, seed)
@@ -46,11 +96,56 @@ def run_genomcmcgan(
 
     # Use GPUs for Discriminator operations if possible
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    # Input shapes are fixed, so let cuDNN benchmark and pick the fastest
+    # convolutions, and allow TF32 tensor cores for float32 matmuls
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+
+    # NHWC (channels_last) layout for the tensor core convolution kernels
+    mcmcgan.discriminator.to(memory_format=torch.channels_last)
+
+    mcmcgan.discriminator.to(device)
+
+    # Compile the discriminator in place to fuse its kernels, as fit() and
+    # predict() call the module directly instead of a torch.compile wrapper.
+    # CUDA graphs are left out, as their state is thread-local and D(x) runs
+    # inside tf.py_function on a TensorFlow thread. Compilation is lazy, so a
+    # separate compiled handle is warmed up first, and the module is only
+    # compiled if that works. Otherwise the discriminator runs eagerly
+    if device.type == "cuda":
+        compile_mode = "max-autotune-no-cudagraphs"
+        try:
+            compiled = torch.compile(mcmcgan.discriminator, mode=compile_mode)
+            warmup = torch.zeros((2, *xtrain.shape[1:]), dtype=torch.uint8)
+            warmup = warmup.to(device).contiguous(memory_format=torch.channels_last)
+            mcmcgan.discriminator.eval()
+            with torch.no_grad():
+                compiled(warmup)
+        except Exception as e:
+            print(f"Discriminator will not be compiled: {e}")
+        else:
+            mcmcgan.discriminator.compile(mode=compile_mode)
+
+    # The DataParallel wrapper stays outside of the compiled module
     if torch.cuda.device_count() > 1:
         print("Using", torch.cuda.device_count(), "GPUs")
         mcmcgan.discriminator = nn.DataParallel(mcmcgan.discriminator)
     mcmcgan.discriminator.to(device)
 
+    # Cap the PyTorch caching allocator, leaving room for the memory reserved
+    # for the TF MCMC kernels and for the CUDA contexts of both libraries,
+    # which neither allocator accounts for
+    reserved = (tf_gpu_memory + 512) * 2 ** 20
+    for i in range(torch.cuda.device_count()):
+        total = torch.cuda.get_device_properties(i).total_memory
+        if reserved >= total:
+            raise ValueError(
+                f"GPU {i} has {total // 2 ** 20} MB, which does not fit the "
+                f"{tf_gpu_memory} MB of --tf-gpu-memory and the CUDA contexts"
+            )
+        torch.cuda.set_per_process_memory_fraction(1 - reserved / total, i)
+
     print(f"Demographic model for inference - {mcmcgan.genob.demo_model}")
     for p in mcmcgan.genob.params.values():
         print(f"{p.name} inferable: {p.inferable}")
@@ -58,6 +153,7 @@ def run_genomcmcgan(
     max_num_iters = 10
     start_t = time.time()
     means = [0.0]
+    trainflow, valflow = None, None
 
     while max_num_iters != mcmcgan.iter:
 
@@ -65,18 +161,26 @@ def run_genomcmcgan(
         print(f"Starting the MCMC sampling chain for iteration {mcmcgan.iter}")
         t = time.time()
 
-        # Prepare tensors and data loaders with the data and labels
-        xtrain = torch.Tensor(xtrain).float().to(device)
-        ytrain = torch.Tensor(ytrain).float().unsqueeze(-1).to(device)
-        trainset = torch.utils.data.TensorDataset(xtrain, ytrain)
-        trainflow = torch.utils.data.DataLoader(trainset, 32, True)
-        xval = torch.Tensor(xval).float().to(device)
-        yval = torch.Tensor(yval).float().unsqueeze(-1).to(device)
-        valset = torch.utils.data.TensorDataset(xval, yval)
-        valflow = torch.utils.data.DataLoader(valset, 32, True)
+        # Fill the data loaders with the data and labels. Tensors stay on the
+        # host and batches are copied to the device while training
+        trainflow = update_dataloader(trainflow, xtrain, ytrain, device)
+        valflow = update_dataloader(valflow, xval, yval, device, shuffle=False)
 
         # After wrapping the cnn model with DataParallel, -.module.- is necessary
-        best_acc = mcmcgan.discriminator.module.fit(trainflow, valflow, epochs, lr=0.0001)
+        # The discriminator is trained from scratch only in the first iteration.
+        # Afterwards the proposals shift slightly, so it is only fine-tuned
+        if mcmcgan.iter == 1:
+            best_acc = mcmcgan.discriminator.module.fit(
+                trainflow, valflow, epochs, lr=0.0001
+            )
+        else:
+            best_acc = mcmcgan.discriminator.module.fit(
+                trainflow,
+                valflow,
+                epochs,
+                lr=fine_tune_lr,
+                fine_tune_steps=min(len(trainflow), fine_tune_steps),
+            )
 
         # Check for convergence
         if best_acc < 0.55:
@@ -91,26 +195,25 @@ def run_genomcmcgan(
         posterior, sample_stats = mcmcgan.result_to_stats()
         mcmc_diagnostic_plots(posterior, sample_stats, it=mcmcgan.iter)
 
-        # Draw traceplot and histogram of collected samples
-        mcmcgan.traceplot_samples()
-        mcmcgan.hist_samples()
-        if len(mcmcgan.samples) > 1:
-            mcmcgan.jointplot_samples()
-
-        # Calculate means and standard deviations for the next MCMC sampling step
-        means = np.mean(mcmcgan.samples, axis=1)
-        stds = np.std(mcmcgan.samples, axis=1)
-        for i, p in enumerate(mcmcgan.genob.inferable_params):
-            # Update the MCMC stats for each parameter
-            print(f"{p.name} samples with mean {means[i]} and std {stds[i]}")
-            p.proposals = mcmcgan.samples[i]
-            p.init = mcmcgan.samples[i][-1]
+        # Draw traceplots, histograms and jointplots of collected samples
+        mcmcgan.plot_all()
+
+        # Update the MCMC state of the parameters for the next sampling step
+        mcmcgan.update_params(sample_stats)
+        means = np.mean(mcmcgan.param_proposals, axis=1)
+        stds = np.std(mcmcgan.param_proposals, axis=1)
+        for p, mean, std in zip(mcmcgan.genob.inferable_params, means, stds):
+            print(f"{p.name} samples with mean {mean} and std {std}")
 
         # Generate new batches of real data and updated simulated data
         xtrain, xval, ytrain, yval = mcmcgan.genob.generate_data(
             num_mcmc_samples, proposals=True
         )
 
+        # Release cached blocks between iterations only, never during training
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
         print(f"A single iteration of the MCMC-GAN took {time.time()-t} seconds")
         print(f"In total, it has been running for {time.time()-start_t} seconds")
 
@@ -144,7 +247,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "-d",
         "--data-path",
-        help="Path to genotype matrices data stored as a pickle object",
+        help="Path to genotype matrices data saved by genobuilder.py download_genmats "
+        "(read with genobuilder.load_genmats). If the file does not exist, the "
+        "simulated data is saved there for later runs",
         type=str,
     )
 
@@ -158,7 +263,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-e",
         "--epochs",
-        help="Number of epochs to train the discriminator on real and fake data on each iteration of MCMCGAN",
+        help="Number of epochs to train the discriminator on real and fake data in the first iteration of MCMCGAN. Later iterations only fine-tune it, see --fine-tune-steps",
         type=int,
         default=5,
     )
@@ -195,6 +300,30 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "-ft",
+        "--fine-tune-steps",
+        help="Maximum number of mini-batches to fine-tune the discriminator in each iteration of MCMCGAN after the first one",
+        type=positive_int,
+        default=200,
+    )
+
+    parser.add_argument(
+        "-flr",
+        "--fine-tune-lr",
+        help="Learning rate to fine-tune the discriminator in each iteration of MCMCGAN after the first one",
+        type=float,
+        default=0.00001,
+    )
+
+    parser.add_argument(
+        "-tfm",
+        "--tf-gpu-memory",
+        help="GPU memory in MB reserved for TensorFlow to run the MCMC kernels. The rest, minus 512 MB for the CUDA contexts, is left to the PyTorch discriminator",
+        type=int,
+        default=1024,
+    )
+
     # Get argument values from parser
     args = parser.parse_args()
 
@@ -208,6 +337,9 @@ if __name__ == "__main__":
         args.num_mcmc_burnin,
         args.seed,
         args.parallelism,
+        args.fine_tune_steps,
+        args.fine_tune_lr,
+        args.tf_gpu_memory,
     )
 
     # Command example:
@@ -2,6 +2,7 @@ import copy
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
+from scipy.stats import gaussian_kde
 import pickle
 import torch
 import os
@@ -13,6 +14,20 @@ import tensorflow as tf
 import tensorflow_probability as tfp
 
 
+def limit_tf_gpu_memory(memory_limit):
+    """Reserve at most `memory_limit` MB of each GPU for TensorFlow, which only
+    runs the MCMC kernels while the discriminator is trained with PyTorch on the
+    same GPUs. Must be called before TensorFlow initializes its devices"""
+
+    try:
+        for gpu in tf.config.list_physical_devices("GPU"):
+            tf.config.set_logical_device_configuration(
+                gpu, [tf.config.LogicalDeviceConfiguration(memory_limit=memory_limit)]
+            )
+    except RuntimeError as e:
+        print(f"TensorFlow GPU memory could not be limited: {e}")
+
+
 class MCMCGAN:
     """Class for building the coupled MCMC-Discriminator architecture"""
 
@@ -25,17 +40,27 @@ class MCMCGAN:
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.iter = 0
 
+        # MCMC state of the inferable parameters, stored as [K, ...] arrays
+        params = self.genob.inferable_params
+        self.param_bounds = np.array([p.bounds for p in params], dtype=np.float32)
+        self.param_inits = self.genob.inferable_inits
+        self.param_step_sizes = np.array(
+            [p.step_size for p in params], dtype=np.float32
+        )
+        self.param_proposals = None
+
     def D(self):
         """
         Simulate with parameters `x`, then classify the simulations with the
         discriminator. Returns the average over `num_replicates` simulations.
         """
 
-        genmats = torch.Tensor(self.genob.simulate_msprime(self.proposals)).to(
-            self.device
-        )
-        out = self.discriminator.module.predict(genmats).cpu().numpy()
-        return np.mean(out.astype(np.float32))
+        # Overwrite the preallocated input in place instead of a new tensor
+        genmats = self.genob.simulate_msprime(self.proposals)
+        self.genmats.copy_(torch.from_numpy(genmats))
+
+        # Average on the device, so only a scalar is copied back to the host
+        return self.discriminator.module.predict(self.genmats).float().mean().item()
 
     # Where `D(x)` is the average discriminator output from n independent
     # simulations (which are simulated with parameters `x`).
@@ -49,7 +74,11 @@ class MCMCGAN:
         return tf.math.log(score)
 
     def target_log_prob(self, *x):
-        return tf.py_function(self._target_log_prob, inp=x, Tout=tf.float32)
+        # The py_function output has an unknown shape in graph mode, so set it
+        # to a scalar for the MCMC kernels to trace without running eagerly
+        log_prob = tf.py_function(self._target_log_prob, inp=x, Tout=tf.float32)
+        log_prob.set_shape([])
+        return log_prob
 
     def setup_mcmc(
         self,
@@ -59,26 +88,32 @@ class MCMCGAN:
         num_reps_Dx,
     ):
 
-        tf.config.run_functions_eagerly(True)
         self.proposals = copy.deepcopy(self.genob.params)
         self.num_mcmc_results = num_mcmc_results
         self.num_burnin_steps = num_burnin_steps
         self.thinning = thinning
         self.genob.num_reps = num_reps_Dx
+        self.genmats = torch.empty(
+            (num_reps_Dx, 1, self.genob.num_samples, self.genob.fixed_dim),
+            dtype=torch.uint8,
+            device=self.device,
+            memory_format=torch.channels_last,
+        )
         self.samples = None
         self.stats = None
         tfb = tfp.bijectors
 
-        self.bijs, self.inits, self.step_sizes = [], [], []
-        for p in self.genob.inferable_params:
-            self.bijs.append(
-                tfb.Sigmoid(
-                    low=tf.cast(p.bounds[0], tf.float32),
-                    high=tf.cast(p.bounds[1], tf.float32),
-                ),
-            )
-            self.inits.append(tf.cast(p.init, tf.float32))
-            self.step_sizes.append(tf.cast(p.step_size, tf.float32))
+        self.bijs = [tfb.Sigmoid(low=lo, high=hi) for lo, hi in self.param_bounds]
+        self.inits = tf.unstack(tf.constant(self.param_inits))
+        self.step_sizes = tf.unstack(tf.constant(self.param_step_sizes))
+
+        # The state is always K float32 scalars, so the target log-prob is
+        # traced only once per chain instead of on new Python-side calls
+        target_log_prob = tf.function(
+            self.target_log_prob,
+            input_signature=[tf.TensorSpec([], tf.float32)] * len(self.param_inits),
+            autograph=False,
+        )
 
         if self.kernel_name not in ["hmc", "nuts"]:
             raise NameError("kernel value must be either hmc or nuts")
@@ -87,7 +122,7 @@ class MCMCGAN:
         elif self.kernel_name == "hmc":
             sampler = tfp.mcmc.TransformedTransitionKernel(
                 tfp.mcmc.HamiltonianMonteCarlo(
-                    target_log_prob_fn=self.target_log_prob,
+                    target_log_prob_fn=target_log_prob,
                     num_leapfrog_steps=6,
                     step_size=self.step_sizes,
                 ),
@@ -106,7 +141,7 @@ class MCMCGAN:
         elif self.kernel_name == "nuts":
             sampler = tfp.mcmc.TransformedTransitionKernel(
                 tfp.mcmc.NoUTurnSampler(
-                    target_log_prob_fn=self.target_log_prob,
+                    target_log_prob_fn=target_log_prob,
                     step_size=self.step_sizes,
                     max_tree_depth=8,
                 ),
@@ -126,6 +161,38 @@ class MCMCGAN:
                 log_accept_prob_getter_fn=lambda pkr: pkr.inner_results.log_accept_ratio,
             )
 
+        # Stats to collect during the chain simulation
+        trace_fn = (
+            self.trace_fn_nuts if self.kernel_name == "nuts" else self.trace_fn_hmc
+        )
+        tf_seed = tf.constant(self.seed) if self.seed else None
+
+        # Add a progress bar for the chain sampling iterations
+        t = self.thinning
+        self.pbar = tfp.experimental.mcmc.ProgressBarReducer(
+            self.num_mcmc_results * (t + 1) + self.num_burnin_steps - t
+        )
+        kernel = tfp.experimental.mcmc.WithReductions(self.mcmc_kernel, self.pbar)
+
+        # The chain driver is traced once per setup, taking the initial state
+        # as input so it is not baked into the graph as a constant.
+        # autograph=False is recommended by the TFP team. It is related to how
+        # control-flow statements are handled. XLA compilation is not possible
+        # here, as the target_log_prob runs the simulator in a py_function.
+        @tf.function(autograph=False)
+        def _sampled_chain(init):
+            return tfp.mcmc.sample_chain(
+                num_results=self.num_mcmc_results,
+                num_burnin_steps=self.num_burnin_steps,
+                current_state=init,
+                kernel=kernel,
+                seed=tf_seed,
+                num_steps_between_results=self.thinning,
+                trace_fn=trace_fn,
+            )
+
+        self._sampled_chain = _sampled_chain
+
     def trace_fn_nuts(self, _, pkr):
         """Trace function to collect stats during NUTS sampling"""
         results = pkr.inner_results.inner_results.inner_results
@@ -148,49 +215,46 @@ class MCMCGAN:
             results.accepted_results.step_size,
         )
 
-    # autograph=False is recommended by the TFP team. It is related to how
-    # control-flow statements are handled.
-    # experimental_compile=True for higher efficiency in XLA_GPUs, TPUs, etc...
-    @tf.function(autograph=False, experimental_compile=True)
     def run_chain(self):
         """Run the MCMC chain with the specified kernel"""
 
-        # Stats to collect during the chain simulation
-        trace_fn = (
-            self.trace_fn_nuts if self.kernel_name == "nuts" else self.trace_fn_hmc
-        )
-
-        tf_seed = tf.constant(self.seed) if self.seed else None
         print(f"Selected mcmc kernel is {self.kernel_name}")
 
-        # Add a progress bar for the chain sampling iterations
-        t = self.thinning
-        pbar = tfp.experimental.mcmc.ProgressBarReducer(
-            self.num_mcmc_results * (t + 1) + self.num_burnin_steps - t
-        )
-        self.mcmc_kernel = tfp.experimental.mcmc.WithReductions(self.mcmc_kernel, pbar)
-
         # Run the chain
-        samples, stats = tfp.mcmc.sample_chain(
-            num_results=self.num_mcmc_results,
-            num_burnin_steps=self.num_burnin_steps,
-            current_state=self.inits,
-            kernel=self.mcmc_kernel,
-            seed=tf_seed,
-            num_steps_between_results=self.thinning,
-            trace_fn=trace_fn,
-        )
-        pbar.bar.close()
+        samples, stats = self._sampled_chain(self.inits)
+        self.pbar.bar.close()
         print("sampling finished")
 
-        # Collect the samples and stats. Download as a pickle file
-        # self.samples = [s[stats[2]].numpy() for s in samples]
-        self.samples = [s.numpy() for s in samples]
-        self.stats = stats
+        # Collect the samples as a single [K, num_results] array, so they are
+        # copied from the device at once. The stats have mixed dtypes and are
+        # copied one tensor at a time. Download as a pickle file
+        self.samples, self.stats = tf.nest.map_structure(
+            lambda t: t.numpy(), (tf.stack(samples), stats)
+        )
         pack = [self.samples, self.stats]
         with open(f"./results/output_it{self.iter}.pkl", "wb") as obj:
             pickle.dump(pack, obj, protocol=pickle.HIGHEST_PROTOCOL)
 
+    def update_params(self, sample_stats):
+        """Use the samples of the last chain as the proposals and initial
+        states of the next one. The [K, num_results] samples array is used as
+        the proposals without copying it, and only the last samples and step
+        sizes are copied into the arrays of initial states and step sizes.
+        Each Parameter gets its row of proposals as a view, and its initial
+        state and step size as scalars"""
+
+        self.param_proposals = self.samples
+        self.param_inits[:] = self.param_proposals[:, -1]
+
+        # Keep the adapted step sizes, already copied to the host with the samples
+        if "step_size" in sample_stats:
+            self.param_step_sizes[:] = [s[-1] for s in sample_stats["step_size"]]
+
+        for i, p in enumerate(self.genob.inferable_params):
+            p.proposals = self.param_proposals[i]
+            p.init = self.param_inits[i]
+            p.step_size = self.param_step_sizes[i]
+
     def result_to_stats(self):
         """Convert results from running the MCMC chain into a posterior list
         and sample_stats list that can be given to Arviz for visualizations"""
@@ -220,81 +284,72 @@ class MCMCGAN:
 
         return posterior, sample_stats
 
-    def hist_samples(self, bins=10):
-        """Plot a histogram of the collected samples for a given parameter"""
+    def plot_all(self, bins=30):
+        """Plot the traceplot, histogram and jointplot of the collected samples
+        for all parameters in a single figure. The histograms and densities
+        are computed once per parameter, or per pair of parameters"""
 
+        params = self.genob.inferable_params
+        samples = np.asarray(self.samples)
         colors = ["red", "blue", "green", "black", "teal", "gold", "chocolate"]
         sns.set_style("darkgrid")
-        plt.clf()
-        for i, p in enumerate(self.genob.inferable_params):
-            sns.distplot(self.samples[i], color=colors[i])
-            ymax = plt.ylim()[1]
-            if self.genob.source == "msprime":
-                plt.vlines(p.val, 0, ymax, color=colors[i])
-            plt.ylim(0, ymax)
-            plt.legend([p.name])
-            plt.xlabel("Values")
-            plt.ylabel("Density")
-            plt.title(
-                f"{self.kernel_name} samples for {p.name} at iteration {self.iter}"
-            )
-            plt.savefig(
-                f"./results/mcmcgan_{self.kernel_name}_histogram_it{self.iter}"
-                f"_{p.name}.png"
-            )
-            plt.clf()
+        fig, axes = plt.subplots(
+            3, len(params), figsize=(5 * len(params), 13), squeeze=False
+        )
 
-    def traceplot_samples(self):
-        """Plot a traceplot of the MCMC chain states for a given parameter"""
+        for i, p in enumerate(params):
+            c = colors[i % len(colors)]
+            x = samples[i]
 
-        # EXPAND COLORS FOR MORE PARAMETERS
-        colors = ["red", "blue", "green", "black", "teal", "gold", "chocolate"]
-        sns.set_style("darkgrid")
-        plt.clf()
-        for i, p in enumerate(self.genob.inferable_params):
-            plt.plot(self.samples[i], c=colors[i], alpha=0.3)
+            # Trace plot of the chain states
+            ax = axes[0, i]
+            ax.plot(x, c=c, alpha=0.3)
             if self.genob.source == "msprime":
-                plt.hlines(
-                    p.val,
-                    0,
-                    len(self.samples),
-                    zorder=4,
-                    color=colors[i],
-                    label="${}$".format(i),
-                )
-            plt.legend([p.name])
-            plt.xlabel("Accepted samples")
-            plt.ylabel("Values")
-            plt.title(
-                f"Trace plot of {self.kernel_name} samples for {p.name} at {self.iter}."
-            )
-            plt.savefig(
-                f"./results/mcmcgan_{self.kernel_name}_traceplot_it{self.iter}"
-                f"_{p.name}.png"
-            )
-            plt.clf()
-
-    def jointplot_samples(self):
-        """Plot a jointplot of two variables with marginal density histograms"""
-
-        params = self.genob.inferable_params
-        log = [p.plotlog for p in params]
-        plt.clf()
-
-        g = sns.jointplot(
-            x=self.samples[0],
-            y=self.samples[1],
-            kind="hist",
-            bins=30,
-            log_scale=log[:2],
-            height=10,
-            ratio=3,
-            space=0,
+                ax.axhline(p.val, zorder=4, color=c)
+            ax.set_xlabel("Accepted samples")
+            ax.set_ylabel("Values")
+            ax.set_title(f"Trace plot of {p.name}")
+
+            # Histogram with the kernel density estimate on top
+            ax = axes[1, i]
+            counts, edges = np.histogram(x, bins=bins, density=True)
+            ax.hist(edges[:-1], edges, weights=counts, color=c, alpha=0.4)
+            if np.ptp(x) > 0:
+                grid = np.linspace(edges[0], edges[-1], 200)
+                ax.plot(grid, gaussian_kde(x)(grid), color=c)
+            if self.genob.source == "msprime":
+                ax.axvline(p.val, color=c)
+            ax.set_xlabel("Values")
+            ax.set_ylabel("Density")
+            ax.set_title(f"Histogram of {p.name}")
+
+            # Joint 2D histogram and density with the next parameter. With one
+            # or two parameters the last column would repeat an existing pair
+            ax = axes[2, i]
+            if len(params) <= 2 and i == len(params) - 1:
+                ax.set_visible(False)
+                continue
+            j = (i + 1) % len(params)
+            y = samples[j]
+            h, xedges, yedges = np.histogram2d(x, y, bins=bins)
+            ax.pcolormesh(xedges, yedges, h.T, cmap="Blues")
+            if np.ptp(x) > 0 and np.ptp(y) > 0:
+                xx, yy = np.meshgrid(xedges, yedges)
+                try:
+                    kde = gaussian_kde(np.vstack([x, y]))
+                    zz = kde(np.vstack([xx.ravel(), yy.ravel()])).reshape(xx.shape)
+                    ax.contour(xx, yy, zz, levels=6, colors="k", alpha=0.75)
+                except np.linalg.LinAlgError:
+                    pass
+            ax.set_xscale("log" if p.plotlog else "linear")
+            ax.set_yscale("log" if params[j].plotlog else "linear")
+            ax.set_xlabel(p.name)
+            ax.set_ylabel(params[j].name)
+            ax.set_title(f"Jointplot of {p.name} and {params[j].name}")
+
+        fig.suptitle(f"{self.kernel_name} samples at iteration {self.iter}")
+        fig.tight_layout()
+        fig.savefig(
+            f"./results/mcmcgan_{self.kernel_name}_samples_it{self.iter}.png", dpi=100
         )
-        g.plot_joint(sns.kdeplot, color="k", zorder=1, levels=6, alpha=0.75)
-        g.plot_marginals(sns.rugplot, color="r", height=-0.1, clip_on=False, alpha=0.1)
-        plt.xlabel(params[0].name)
-        plt.ylabel(params[1].name)
-        plt.title(f"Jointplot at iteration {self.iter}")
-        plt.savefig(f"./results/jointplot_{self.iter}.png")
-        plt.clf()
+        plt.close(fig)